@@ -1,18 +1,29 @@
+import argparse
 import asyncio
+import atexit
 import json
 import os
+import re
 import datetime
-import uuid
-from typing import Dict, List, Optional
-from functools import lru_cache
+import secrets
+from collections import deque
+from types import MappingProxyType
+from typing import Dict, List, Optional, Tuple
 import logging
-import requests
+import threading
+import time
+import httpx
 from dotenv import load_dotenv
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 from langchain_ollama import ChatOllama
-from langchain_core.tools import tool
+from langchain_core.tools import BaseTool, tool
 from langgraph.prebuilt import create_react_agent
 
+try:
+    import orjson
+except ImportError:  # 未安裝 orjson 時退回標準庫 json
+    orjson = None
+
 logging.basicConfig(
     filename="tcm_agent.log",
     level=logging.INFO,
@@ -25,6 +36,16 @@ if not OPENWEATHER_API_KEY:
     print("警告：未找到 OPENWEATHER_API_KEY，天氣相關功能將無法使用。")
     # logging.warning("未找到 OPENWEATHER_API_KEY，天氣相關功能將無法使用。")
 
+def dump_json(obj, indent: bool = False) -> bytes:
+    """序列化為 UTF-8 JSON，優先使用 orjson"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None).encode("utf-8")
+
+def load_json(data: bytes):
+    """解析 JSON，優先使用 orjson"""
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
 # === 中醫舌診專業 System Prompt (TCM Tongue Diagnosis System Prompt) ===
 TCM_SYSTEM_PROMPT = """
 你是一位專業的中醫舌診智能助手，具備以下專業知識和特點：
@@ -64,12 +85,20 @@ TCM_SYSTEM_PROMPT = """
 ⚠️ 當用戶輸入任何舌象描述（如「舌頭有紅點」、「舌苔黃厚」等），請務必呼叫舌象分析工具（enhanced_tongue_analysis），不要自行生成分析內容。
 """
 
+# System Prompt 於每輪對話共用同一個訊息物件
+SYSTEM_MESSAGE = SystemMessage(content=TCM_SYSTEM_PROMPT)
+
+# ChatOllama 內建 ollama.AsyncClient，透過 ainvoke 走非同步路徑
 llm = ChatOllama(
     model="llama3.2",
     temperature=0.7,
 )
 
-TONGUE_DATABASE = {
+# 與 Ollama 伺服器端的 OLLAMA_NUM_PARALLEL 對齊，限制同時送出的請求數（至少為 1）
+OLLAMA_NUM_PARALLEL = max(1, int(os.getenv("OLLAMA_NUM_PARALLEL", "4")))
+llm_semaphore = asyncio.Semaphore(OLLAMA_NUM_PARALLEL)
+
+TONGUE_DATABASE = MappingProxyType({
     "舌頭有紅點": {
         "體質": "內熱過盛",
         "症狀": ["口乾", "煩躁", "失眠"],
@@ -126,104 +155,270 @@ TONGUE_DATABASE = {
         "禁忌": ["過度進補"],
         "中醫理論": "舌淡紅苔薄白為正常舌象，氣血調和之徵"
     }
-}
+})
+
+# 體質 → 舌象鍵的反向索引，取代逐筆掃描 TONGUE_DATABASE
+CONSTITUTION_TO_KEY: Dict[str, str] = {}
+for _key, _info in TONGUE_DATABASE.items():
+    CONSTITUTION_TO_KEY.setdefault(_info["體質"], _key)
+
+def render_analysis_template(tongue_type: str, tongue_info: Dict) -> str:
+    """預先組裝舌象分析內容，僅保留 {record_id} 佔位符於執行時替換"""
+    return f"""
+親愛的用戶，感謝您的信任。根據您提供的舌象描述，以下是專業分析與建議：
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+📋 分析編號：{{record_id}}...
+👅 舌象描述：{tongue_type}
+🏥 對應體質：{tongue_info["體質"]}
+
+📚 【中醫理論基礎】
+{tongue_info["中醫理論"]}
+
+💊 【調理原則】
+{tongue_info["建議"]}
+
+🍵 【推薦食療方】
+• {' • '.join(tongue_info["食療"])}
+
+⚠️ 【飲食宜忌】
+應避免：{' • '.join(tongue_info["禁忌"])}
+
+🩺 【常見伴隨症狀】
+• {' • '.join(tongue_info["症狀"])}
+
+📝 【專業提醒】
+此分析僅供參考，如症狀持續或加重，建議諮詢專業中醫師進行全面診斷。
+"""
+
+ANALYSIS_TEMPLATES = {k: render_analysis_template(k, v) for k, v in TONGUE_DATABASE.items()}
+
+# 錯誤提示中列出的可分析舌象類型
+AVAILABLE_TYPES_BULLETS = "\n".join(f"• {t}" for t in TONGUE_DATABASE)
+
+# 預先編譯舌象前綴比對（長鍵優先），以單次 C 層級比對取代逐鍵 startswith
+TONGUE_PREFIX_PATTERN = re.compile(
+    "|".join(re.escape(k) for k in sorted(TONGUE_DATABASE, key=len, reverse=True))
+)
+
+def compact_record(record: Dict) -> Dict:
+    """將舊格式記錄（ISO 日期字串與重複的時間說明）轉為以整數時間戳記儲存"""
+    if "ts" not in record and "date" in record:
+        try:
+            record["ts"] = int(datetime.datetime.fromisoformat(record["date"]).timestamp())
+        except (ValueError, TypeError):
+            return record
+        del record["date"]
+    record.pop("date_short", None)
+    record.pop("weather_info", None)
+    return record
+
+class UserProfile:
+    """用戶健康檔案；以 __slots__ 儲存欄位，磁碟上仍為原本的字典格式"""
+    __slots__ = ("name", "age", "gender", "created_at", "tongue_records", "constitution_trends", "preferences")
+
+    def __init__(self, name: str = "", age: int = 0, gender: str = "", created_at: Optional[str] = None,
+                 tongue_records: Optional[List[Dict]] = None, constitution_trends: Optional[Dict[str, int]] = None,
+                 preferences: Optional[Dict] = None):
+        self.name = name
+        self.age = age
+        self.gender = gender
+        self.created_at = created_at or datetime.datetime.now().isoformat()
+        self.tongue_records = tongue_records if tongue_records is not None else []
+        self.constitution_trends = constitution_trends if constitution_trends is not None else {}
+        self.preferences = preferences if preferences is not None else {}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "UserProfile":
+        profile = cls(**{k: data[k] for k in cls.__slots__ if k in data})
+        profile.tongue_records = [compact_record(r) for r in profile.tongue_records]
+        return profile
+
+    def to_dict(self) -> Dict:
+        return {k: getattr(self, k) for k in self.__slots__}
 
 class UserHealthManager:
-    def __init__(self, data_file="users_health_data.json"):
+    # 累積多少筆未落地的變更後壓縮成一次完整快照
+    SNAPSHOT_THRESHOLD = 16
+
+    def __init__(self, data_file="users_health_data.json", journal_file="records.log"):
         self.data_file = data_file
-        self.users = {}
+        self.journal_file = journal_file
+        self.users: Dict[str, UserProfile] = {}
+        self._pending_writes = 0
+        # 每位用戶最近一次的體質分析結果，以記錄筆數判斷是否過期
+        self._analysis_cache: Dict[str, tuple] = {}
+        # 工具可能在執行緒池中並行執行，寫入路徑需互斥
+        self._lock = threading.RLock()
         self.load_data()
+        self._journal = open(self.journal_file, "ab", buffering=0)
+        atexit.register(self.flush)
 
     def load_data(self):
-        """載入用戶數據"""
+        """載入用戶數據：先讀快照，再重播尚未壓縮的日誌"""
         try:
             if os.path.exists(self.data_file):
-                with open(self.data_file, "r", encoding="utf-8") as f:
-                    self.users = json.load(f)
+                with open(self.data_file, "rb") as f:
+                    raw = load_json(f.read())
+                self.users = {uid: UserProfile.from_dict(d) for uid, d in raw.items()}
         except Exception as e:
             logging.error(f"載入用戶數據失敗: {str(e)}")
             self.users = {}
+        self.replay_journal()
+
+    def replay_journal(self):
+        """重播日誌中的新用戶與舌象記錄，已存在於快照中的項目會被略過"""
+        if not os.path.exists(self.journal_file):
+            return
+        known_ids = {
+            record["record_id"]
+            for user in self.users.values()
+            for record in user.tongue_records
+        }
+        with open(self.journal_file, "rb") as f:
+            for line in f:
+                try:
+                    entry = load_json(line)
+                except ValueError:
+                    logging.warning(f"略過無法解析的日誌行: {line.strip()[:80]!r}")
+                    continue
+                user_id = entry["user_id"]
+                if "profile" in entry:
+                    if user_id not in self.users:
+                        self.users[user_id] = UserProfile.from_dict(entry["profile"])
+                        self._pending_writes += 1
+                    continue
+                record = compact_record(entry["record"])
+                if record["record_id"] in known_ids:
+                    continue
+                user = self.users.get(user_id)
+                if user is None:
+                    user = self.users[user_id] = UserProfile()
+                user.tongue_records.append(record)
+                self.update_constitution_trends(user_id, record["constitution"])
+                known_ids.add(record["record_id"])
+                self._pending_writes += 1
 
     def save_data(self):
-        """保存用戶數據"""
+        """保存完整快照並清空日誌"""
+        with self._lock:
+            try:
+                tmp_file = f"{self.data_file}.tmp"
+                with open(tmp_file, "wb") as f:
+                    f.write(dump_json({uid: u.to_dict() for uid, u in self.users.items()}, indent=True))
+                os.replace(tmp_file, self.data_file)
+                self._journal.seek(0)
+                self._journal.truncate()
+                self._pending_writes = 0
+            except Exception as e:
+                logging.error(f"保存用戶數據失敗: {str(e)}")
+
+    def append_journal(self, entry: Dict):
+        """追加一筆日誌並計入待壓縮的變更數"""
         try:
-            with open(self.data_file, "w", encoding="utf-8") as f:
-                json.dump(self.users, f, ensure_ascii=False, indent=2)
+            self._journal.write(dump_json(entry) + b"\n")
+            self._pending_writes += 1
         except Exception as e:
-            logging.error(f"保存用戶數據失敗: {str(e)}")
+            logging.error(f"寫入記錄日誌失敗: {str(e)}")
+
+    def snapshot_if_dirty_threshold(self):
+        """日誌累積達門檻時才寫入完整快照"""
+        if self._pending_writes >= self.SNAPSHOT_THRESHOLD:
+            self.save_data()
+
+    def flush(self):
+        """程式結束時寫入尚未落地的變更"""
+        if self._pending_writes:
+            self.save_data()
 
     def create_user(self, user_id: str, name: str = "", age: int = 0, gender: str = ""):
         """創建新用戶"""
-        if user_id not in self.users:
-            self.users[user_id] = {
-                "name": name,
-                "age": age,
-                "gender": gender,
-                "created_at": datetime.datetime.now().isoformat(),
-                "tongue_records": [],
-                "constitution_trends": {},
-                "preferences": {}
-            }
-            self.save_data()
-            logging.info(f"創建新用戶: {user_id}")
-            return True
-        return False
+        with self._lock:
+            if user_id not in self.users:
+                profile = self.users[user_id] = UserProfile(name, age, gender)
+                self.append_journal({
+                    "user_id": user_id,
+                    "profile": {
+                        "name": profile.name,
+                        "age": profile.age,
+                        "gender": profile.gender,
+                        "created_at": profile.created_at,
+                    },
+                })
+                self.snapshot_if_dirty_threshold()
+                logging.info(f"創建新用戶: {user_id}")
+                return True
+            return False
 
     def add_tongue_record(self, user_id: str, tongue_type: str, constitution: str, symptoms: List[str] = None):
-        """添加舌象記錄"""
+        """添加舌象記錄（追加寫入日誌）"""
         if user_id not in self.users:
             self.create_user(user_id)
 
         record = {
-            "record_id": str(uuid.uuid4()),
-            "date": datetime.datetime.now().isoformat(),
+            "record_id": secrets.token_hex(8),
+            "ts": int(time.time()),
             "tongue_type": tongue_type,
             "constitution": constitution,
-            "symptoms": symptoms or [],
-            "weather_info": f"記錄時間: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M')}"
+            "symptoms": symptoms or []
         }
 
-        self.users[user_id]["tongue_records"].append(record)
-        self.update_constitution_trends(user_id, constitution)
-        self.save_data()
+        with self._lock:
+            self.users[user_id].tongue_records.append(record)
+            self.update_constitution_trends(user_id, constitution)
+            self.append_journal({"user_id": user_id, "record": record})
+            self.snapshot_if_dirty_threshold()
         logging.info(f"添加舌象記錄: {user_id}, {tongue_type}")
         return record["record_id"]
 
     def update_constitution_trends(self, user_id: str, constitution: str):
         """更新體質趨勢統計"""
-        trends = self.users[user_id].setdefault("constitution_trends", {})
+        trends = self.users[user_id].constitution_trends
         trends[constitution] = trends.get(constitution, 0) + 1
 
     def get_user_history(self, user_id: str, limit: int = 10) -> List[Dict]:
-        """獲取用戶歷史記錄"""
-        if user_id in self.users:
-            records = self.users[user_id].get("tongue_records", [])
-            return sorted(records, key=lambda x: x["date"], reverse=True)[:limit]
-        return []
+        """獲取用戶歷史記錄（記錄依寫入順序追加，取尾端反轉即為由新到舊）"""
+        if limit <= 0:
+            return []
+        with self._lock:
+            user = self.users.get(user_id)
+            if user is not None:
+                return user.tongue_records[-limit:][::-1]
+            return []
 
     def get_constitution_analysis(self, user_id: str) -> Dict:
-        """分析用戶體質變化趨勢"""
-        if user_id not in self.users:
-            return {"error": "用戶不存在"}
-
-        trends = self.users[user_id].get("constitution_trends", {})
-        records = self.users[user_id].get("tongue_records", [])
-
-        if not records:
-            return {"message": "暫無記錄可供分析"}
-
-        recent_constitution = records[-1]["constitution"]
-        most_common = max(trends.items(), key=lambda item: item[1]) if trends else ("未知", 0)
-        recent_records = records[-5:]
-        constitutions = [r["constitution"] for r in recent_records]
-
-        return {
-            "recent_constitution": recent_constitution,
-            "most_common_constitution": most_common[0],
-            "constitution_frequency": trends,
-            "recent_trend": constitutions,
-            "total_records": len(records)
-        }
+        """
+        分析用戶體質變化趨勢。
+        結果為快取共用的快照，不受後續寫入影響；呼叫端僅可讀取，不可修改。
+        """
+        with self._lock:
+            user = self.users.get(user_id)
+            if user is None:
+                return {"error": "用戶不存在"}
+
+            records = user.tongue_records
+
+            if not records:
+                return {"message": "暫無記錄可供分析"}
+
+            cached = self._analysis_cache.get(user_id)
+            if cached and cached[0] == len(records):
+                return cached[1]
+
+            trends = dict(user.constitution_trends)
+            recent_constitution = records[-1]["constitution"]
+            most_common = max(trends.items(), key=lambda item: item[1]) if trends else ("未知", 0)
+            recent_records = records[-5:]
+            constitutions = [r["constitution"] for r in recent_records]
+
+            analysis = {
+                "recent_constitution": recent_constitution,
+                "most_common_constitution": most_common[0],
+                "constitution_frequency": trends,
+                "recent_trend": constitutions,
+                "total_records": len(records)
+            }
+            self._analysis_cache[user_id] = (len(records), analysis)
+            return analysis
 
 # 初始化用戶管理器
 user_manager = UserHealthManager()
@@ -240,8 +435,7 @@ def enhanced_tongue_analysis(input_str: str) -> str:
     global current_user_id
     logging.info(f"執行舌象分析: {input_str} for user: {current_user_id}")
     if not input_str or ("|" not in input_str and input_str not in TONGUE_DATABASE):
-        available_types = list(TONGUE_DATABASE.keys())
-        return f"❌ 輸入格式錯誤或舌象類型無法識別。\n請輸入有效的舌象描述，例如：'舌頭有紅點' 或 '舌頭有紅點|口乾,失眠'\n\n📋 目前可分析的舌象類型：\n" + "\n".join([f"• {t}" for t in available_types])
+        return f"❌ 輸入格式錯誤或舌象類型無法識別。\n請輸入有效的舌象描述，例如：'舌頭有紅點' 或 '舌頭有紅點|口乾,失眠'\n\n📋 目前可分析的舌象類型：\n{AVAILABLE_TYPES_BULLETS}"
 
     parts = input_str.split("|")
     tongue_type = parts[0].strip()
@@ -249,8 +443,7 @@ def enhanced_tongue_analysis(input_str: str) -> str:
 
     tongue_info = TONGUE_DATABASE.get(tongue_type)
     if not tongue_info:
-        available_types = list(TONGUE_DATABASE.keys())
-        return f"❌ 未收錄此舌象類型：{tongue_type}\n\n📋 目前可分析的舌象類型：\n" + "\n".join([f"• {t}" for t in available_types])
+        return f"❌ 未收錄此舌象類型：{tongue_type}\n\n📋 目前可分析的舌象類型：\n{AVAILABLE_TYPES_BULLETS}"
 
     record_id = user_manager.add_tongue_record(
         current_user_id,
@@ -259,35 +452,16 @@ def enhanced_tongue_analysis(input_str: str) -> str:
         symptoms
     )
 
-    analysis = f"""
-親愛的用戶，感謝您的信任。根據您提供的舌象描述，以下是專業分析與建議：
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-📋 分析編號：{record_id[:8]}...
-👅 舌象描述：{tongue_type}
-🏥 對應體質：{tongue_info["體質"]}
-
-📚 【中醫理論基礎】
-{tongue_info["中醫理論"]}
-
-💊 【調理原則】
-{tongue_info["建議"]}
-
-🍵 【推薦食療方】
-• {' • '.join(tongue_info["食療"])}
-
-⚠️ 【飲食宜忌】
-應避免：{' • '.join(tongue_info["禁忌"])}
-
-🩺 【常見伴隨症狀】
-• {' • '.join(tongue_info["症狀"])}
-
-📝 【專業提醒】
-此分析僅供參考，如症狀持續或加重，建議諮詢專業中醫師進行全面診斷。
-"""
+    analysis = ANALYSIS_TEMPLATES[tongue_type].replace("{record_id}", record_id[:8])
 
     if symptoms:
-        matched_symptoms = [s for s in symptoms if any(s in expected for expected in tongue_info["症狀"])]
-        unmatched_symptoms = [s for s in symptoms if not any(s in expected for expected in tongue_info["症狀"])]
+        matched_symptoms = []
+        unmatched_symptoms = []
+        for s in symptoms:
+            if any(s in expected for expected in tongue_info["症狀"]):
+                matched_symptoms.append(s)
+            else:
+                unmatched_symptoms.append(s)
 
         analysis += f"\n\n🎯 【症狀對照分析】"
         if matched_symptoms:
@@ -312,18 +486,18 @@ def get_user_health_trends(input_str: str) -> str:
     if "message" in analysis:
         return analysis["message"]
 
-    trend_report = f"📈 【個人健康趨勢分析】\n━━━━━━━━━━━━━━━━━━━━\n"
-    trend_report += f"🎯 當前體質: {analysis['recent_constitution']}\n"
-    trend_report += f"🏆 主要體質: {analysis['most_common_constitution']}\n"
-    trend_report += f"📊 總記錄數: {analysis['total_records']} 次\n\n"
-    trend_report += "📋 【體質分布統計】\n"
+    parts = [f"📈 【個人健康趨勢分析】\n━━━━━━━━━━━━━━━━━━━━\n"]
+    parts.append(f"🎯 當前體質: {analysis['recent_constitution']}\n")
+    parts.append(f"🏆 主要體質: {analysis['most_common_constitution']}\n")
+    parts.append(f"📊 總記錄數: {analysis['total_records']} 次\n\n")
+    parts.append("📋 【體質分布統計】\n")
 
     for constitution, count in analysis["constitution_frequency"].items():
         percentage = (count / analysis["total_records"]) * 100
-        trend_report += f"• {constitution}: {count}次 ({percentage:.1f}%)\n"
+        parts.append(f"• {constitution}: {count}次 ({percentage:.1f}%)\n")
 
-    trend_report += f"\n🔄 【近期變化】\n最近{len(analysis['recent_trend'])}次記錄: {' → '.join(analysis['recent_trend'])}"
-    return trend_report
+    parts.append(f"\n🔄 【近期變化】\n最近{len(analysis['recent_trend'])}次記錄: {' → '.join(analysis['recent_trend'])}")
+    return "".join(parts)
 
 @tool
 def get_user_history_formatted(input_str: str) -> str:
@@ -335,14 +509,14 @@ def get_user_history_formatted(input_str: str) -> str:
     if not history:
         return "📭 暫無歷史記錄"
 
-    history_text = "📚 【歷史記錄】\n━━━━━━━━━━━━━━━━━━━━\n"
+    parts = ["📚 【歷史記錄】\n━━━━━━━━━━━━━━━━━━━━\n"]
     for i, record in enumerate(history, 1):
-        try:
-            date = datetime.datetime.fromisoformat(record["date"]).strftime("%m/%d %H:%M")
-        except (ValueError, TypeError):
-            date = record["date"] # Fallback for old format
-        history_text += f"{i:2d}. {date} | {record['tongue_type']} → {record['constitution']}\n"
-    return history_text
+        if "ts" in record:
+            date = datetime.datetime.fromtimestamp(record["ts"]).strftime("%m/%d %H:%M")
+        else:
+            date = record.get("date", "") # Fallback for unparsable old dates
+        parts.append(f"{i:2d}. {date} | {record['tongue_type']} → {record['constitution']}\n")
+    return "".join(parts)
 
 @tool
 def get_personalized_advice(input_str: str) -> str:
@@ -354,29 +528,29 @@ def get_personalized_advice(input_str: str) -> str:
     if "error" in analysis or "message" in analysis:
         return "請先進行至少一次舌象分析，以便為您提供個性化的中醫養生建議。"
 
-    recent_constitution_key = next((k for k, v in TONGUE_DATABASE.items() if v['體質'] == analysis['recent_constitution']), None)
-    most_common_key = next((k for k, v in TONGUE_DATABASE.items() if v['體質'] == analysis['most_common_constitution']), None)
+    recent_constitution_key = CONSTITUTION_TO_KEY.get(analysis['recent_constitution'])
+    most_common_key = CONSTITUTION_TO_KEY.get(analysis['most_common_constitution'])
     
-    advice = f"🎯 【個人化中醫養生方案】\n━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
-    advice += f"基於您 {analysis['total_records']} 次舌診記錄的分析結果：\n\n"
-    advice += f"🔸 目前主要體質：{analysis['recent_constitution']}\n"
-    advice += f"🔸 長期體質傾向：{analysis['most_common_constitution']}\n\n"
-    advice += "💫 【體質調理重點】\n"
+    parts = [f"🎯 【個人化中醫養生方案】\n━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"]
+    parts.append(f"基於您 {analysis['total_records']} 次舌診記錄的分析結果：\n\n")
+    parts.append(f"🔸 目前主要體質：{analysis['recent_constitution']}\n")
+    parts.append(f"🔸 長期體質傾向：{analysis['most_common_constitution']}\n\n")
+    parts.append("💫 【體質調理重點】\n")
 
     if most_common_key and most_common_key in TONGUE_DATABASE:
         constitution_info = TONGUE_DATABASE[most_common_key]
-        advice += f"🌿 主要調理方向：{constitution_info['建議']}\n"
-        advice += f"🍵 日常食療推薦：\n• {constitution_info['食療'][0]}：建議每日飲用\n• {constitution_info['食療'][1]}：每週2-3次\n"
-        advice += f"🚫 飲食禁忌提醒：\n• {' • '.join(constitution_info['禁忌'])}\n"
+        parts.append(f"🌿 主要調理方向：{constitution_info['建議']}\n")
+        parts.append(f"🍵 日常食療推薦：\n• {constitution_info['食療'][0]}：建議每日飲用\n• {constitution_info['食療'][1]}：每週2-3次\n")
+        parts.append(f"🚫 飲食禁忌提醒：\n• {' • '.join(constitution_info['禁忌'])}\n")
 
     if analysis['recent_constitution'] != analysis['most_common_constitution'] and recent_constitution_key in TONGUE_DATABASE:
         recent_info = TONGUE_DATABASE[recent_constitution_key]
-        advice += f"\n⚠️ 【近期體質變化提醒】\n您的體質最近偏向「{analysis['recent_constitution']}」，建議：\n"
-        advice += f"• 臨時調整：{recent_info['建議']}\n"
-        advice += f"• 近期適合：{', '.join(recent_info['食療'][:2])}\n"
-        advice += f"• 暫時避免：{', '.join(recent_info['禁忌'][:2])}\n"
+        parts.append(f"\n⚠️ 【近期體質變化提醒】\n您的體質最近偏向「{analysis['recent_constitution']}」，建議：\n")
+        parts.append(f"• 臨時調整：{recent_info['建議']}\n")
+        parts.append(f"• 近期適合：{', '.join(recent_info['食療'][:2])}\n")
+        parts.append(f"• 暫時避免：{', '.join(recent_info['禁忌'][:2])}\n")
     
-    advice += f"""
+    parts.append(f"""
 🕒 【養生時間建議】
 • 最佳調理時間：每日清晨空腹時觀察舌象
 • 食療頻率：建議持續3-4週觀察效果
@@ -385,12 +559,71 @@ def get_personalized_advice(input_str: str) -> str:
 🌟 【中醫養生要點】
 「藥補不如食補，食補不如睡補」
 體質調理需要耐心，建議配合規律作息和適量運動效果更佳。
-"""
-    return advice
+""")
+    return "".join(parts)
+
+
+# 常見台灣城市中文到英文自動轉換
+CITY_NAME_MAP = MappingProxyType({
+    "台北": "Taipei",
+    "臺北": "Taipei",
+    "新北": "New Taipei",
+    "台中": "Taichung",
+    "臺中": "Taichung",
+    "台南": "Tainan",
+    "臺南": "Tainan",
+    "高雄": "Kaohsiung",
+    "基隆": "Keelung",
+    "桃園": "Taoyuan",
+    "新竹": "Hsinchu",
+    "嘉義": "Chiayi",
+    "屏東": "Pingtung",
+    "宜蘭": "Yilan",
+    "花蓮": "Hualien",
+    "台東": "Taitung",
+    "臺東": "Taitung",
+    "南投": "Nantou",
+    "彰化": "Changhua",
+    "雲林": "Yunlin",
+    "苗栗": "Miaoli",
+    "澎湖": "Penghu",
+    "金門": "Kinmen",
+    "連江": "Lienchiang",
+})
+
+# === 天氣查詢快取 (Weather Cache) ===
+WEATHER_CACHE_TTL = 600  # 秒
+WEATHER_CACHE_MAXSIZE = 64
+weather_cache: Dict[str, tuple] = {}
+
+weather_client = httpx.AsyncClient(
+    timeout=10,
+    limits=httpx.Limits(max_connections=8, max_keepalive_connections=4),
+)
+
+async def get_weather_cached(city_name: str) -> Dict:
+    """非同步查詢城市天氣，成功結果在 TTL 內重複使用並共用 HTTPS 連線"""
+    now = time.monotonic()
+    cached = weather_cache.get(city_name)
+    if cached and now - cached[0] < WEATHER_CACHE_TTL:
+        return cached[1]
+    try:
+        url = f"https://api.openweathermap.org/data/2.5/weather?q={city_name}&appid={OPENWEATHER_API_KEY}&units=metric&lang=zh_tw"
+        response = await weather_client.get(url)
+        response.raise_for_status()
+        data = response.json()
+    except (httpx.HTTPError, ValueError) as e:
+        logging.error(f"天氣查詢失敗: {str(e)}")
+        return {"error": str(e)}
+    weather_cache.pop(city_name, None)
+    weather_cache[city_name] = (now, data)
+    if len(weather_cache) > WEATHER_CACHE_MAXSIZE:
+        weather_cache.pop(next(iter(weather_cache)))
+    return data
 
 
 @tool
-def weather_constitution_advice(city: str) -> str:
+async def weather_constitution_advice(city: str) -> str:
     """
     結合用戶體質和指定城市當前天氣，提供中醫調理建議。
     輸入格式: '城市名稱'
@@ -401,47 +634,9 @@ def weather_constitution_advice(city: str) -> str:
     if not OPENWEATHER_API_KEY:
         return "❌ 缺少 OpenWeather API 金鑰，無法查詢天氣。"
 
-    # 新增：常見台灣城市中文到英文自動轉換
-    CITY_NAME_MAP = {
-        "台北": "Taipei",
-        "臺北": "Taipei",
-        "新北": "New Taipei",
-        "台中": "Taichung",
-        "臺中": "Taichung",
-        "台南": "Tainan",
-        "臺南": "Tainan",
-        "高雄": "Kaohsiung",
-        "基隆": "Keelung",
-        "桃園": "Taoyuan",
-        "新竹": "Hsinchu",
-        "嘉義": "Chiayi",
-        "屏東": "Pingtung",
-        "宜蘭": "Yilan",
-        "花蓮": "Hualien",
-        "台東": "Taitung",
-        "臺東": "Taitung",
-        "南投": "Nantou",
-        "彰化": "Changhua",
-        "雲林": "Yunlin",
-        "苗栗": "Miaoli",
-        "澎湖": "Penghu",
-        "金門": "Kinmen",
-        "連江": "Lienchiang",
-    }
     city_query = CITY_NAME_MAP.get(city.strip(), city.strip())
 
-    @lru_cache(maxsize=32)
-    def get_weather_cached(city_name: str) -> Dict:
-        try:
-            url = f"https://api.openweathermap.org/data/2.5/weather?q={city_name}&appid={OPENWEATHER_API_KEY}&units=metric&lang=zh_tw"
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            logging.error(f"天氣查詢失敗: {str(e)}")
-            return {"error": str(e)}
-
-    res = get_weather_cached(city_query)
+    res = await get_weather_cached(city_query)
     if res.get("cod") != 200:
         return f"⚠️ 天氣資訊查詢失敗：{res.get('message', '未知錯誤')}\n請檢查城市名稱或網路連線狀態"
 
@@ -452,24 +647,24 @@ def weather_constitution_advice(city: str) -> str:
     analysis = user_manager.get_constitution_analysis(current_user_id)
     constitution = analysis.get("recent_constitution", "未知")
 
-    weather_advice = f"🌤️ 【天人合一調理方案】\n━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
-    weather_advice += f"📍 地點：{city}\n🌡️ 溫度：{temperature}°C\n💧 濕度：{humidity}%\n☁️ 天候：{desc}\n👤 您的體質：{constitution}\n\n"
-    weather_advice += "🍃 【中醫天氣養生理論】\n中醫認為人體應順應天時變化，「天人合一」方能保持健康。\n"
+    parts = [f"🌤️ 【天人合一調理方案】\n━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"]
+    parts.append(f"📍 地點：{city}\n🌡️ 溫度：{temperature}°C\n💧 濕度：{humidity}%\n☁️ 天候：{desc}\n👤 您的體質：{constitution}\n\n")
+    parts.append("🍃 【中醫天氣養生理論】\n中醫認為人體應順應天時變化，「天人合一」方能保持健康。\n")
 
     if humidity > 75:
-        weather_advice += f"\n💧 【濕氣調理】\n當前濕度偏高（{humidity}%），易助長體內濕邪\n• 通用建議：多食祛濕食物如薏仁、冬瓜、赤小豆\n• 避免：冰冷飲品、甜膩食物，以免助濕生痰\n"
+        parts.append(f"\n💧 【濕氣調理】\n當前濕度偏高（{humidity}%），易助長體內濕邪\n• 通用建議：多食祛濕食物如薏仁、冬瓜、赤小豆\n• 避免：冰冷飲品、甜膩食物，以免助濕生痰\n")
         if constitution == "脾虛濕重":
-            weather_advice += "• 您的體質特別容易受濕氣影響，建議加強健脾祛濕，推薦四神湯、茯苓茶。\n"
+            parts.append("• 您的體質特別容易受濕氣影響，建議加強健脾祛濕，推薦四神湯、茯苓茶。\n")
         elif constitution == "濕熱體質":
-            weather_advice += "• 濕熱體質在高濕環境下需特別注意清熱利濕，推薦綠豆薏仁湯、荷葉茶。\n"
+            parts.append("• 濕熱體質在高濕環境下需特別注意清熱利濕，推薦綠豆薏仁湯、荷葉茶。\n")
     
     if temperature > 30:
-        weather_advice += f"\n☀️ 【暑熱調理】\n高溫天氣（{temperature}°C），需注意防暑清熱\n• 建議：綠豆湯、酸梅湯等清暑飲品\n• 避免：過度貪涼，以免寒熱夾雜\n"
+        parts.append(f"\n☀️ 【暑熱調理】\n高溫天氣（{temperature}°C），需注意防暑清熱\n• 建議：綠豆湯、酸梅湯等清暑飲品\n• 避免：過度貪涼，以免寒熱夾雜\n")
     elif temperature < 15:
-        weather_advice += f"\n❄️ 【寒冷調理】\n低溫環境（{temperature}°C），需注意溫陽暖身\n• 建議：生薑茶、桂圓茶等溫性飲品\n• 避免：過食生冷，注意保暖防寒\n"
+        parts.append(f"\n❄️ 【寒冷調理】\n低溫環境（{temperature}°C），需注意溫陽暖身\n• 建議：生薑茶、桂圓茶等溫性飲品\n• 避免：過食生冷，注意保暖防寒\n")
 
-    weather_advice += "\n💡 中醫智慧：「順天時而動，應地利而食，合人和而居」"
-    return weather_advice
+    parts.append("\n💡 中醫智慧：「順天時而動，應地利而食，合人和而居」")
+    return "".join(parts)
 
 # === 工具與 Agent 設置 (Tools and Agent Setup) ===
 tools = [
@@ -483,11 +678,87 @@ tools = [
 # **修正**: 移除 'messages_modifier' 參數
 agent_executor = create_react_agent(llm, tools)
 
+async def ainvoke_agent(messages: List) -> Dict:
+    """非同步呼叫 Agent；同一步驟中的多個工具呼叫由 ToolNode 以 asyncio.gather 並行執行"""
+    async with llm_semaphore:
+        return await agent_executor.ainvoke({"messages": messages})
+
 # === 主程序 (Main Program) ===
-async def main():
+# 不需參數的明確指令直接對應至工具
+COMMAND_TOOLS = {
+    "健康趨勢": get_user_health_trends,
+    "歷史記錄": get_user_history_formatted,
+    "個性化建議": get_personalized_advice,
+}
+
+def record_turn(chat_history: deque, user_input: str, final_answer: str):
+    """記錄一輪對話，超出上限的舊訊息由 deque 自動淘汰"""
+    chat_history.append(HumanMessage(content=user_input))
+    chat_history.append(AIMessage(content=final_answer))
+
+def route(user_input: str) -> Tuple[Optional[BaseTool], str]:
+    """解析輸入對應的工具捷徑，返回 (工具, 工具輸入)；工具為 None 時交由 Agent 處理"""
+    # === 新增：明確指令直接呼叫工具，提升穩定性 ===
+    handler = COMMAND_TOOLS.get(user_input)
+    if handler:
+        return handler, ""
+    if user_input.startswith("天氣"):
+        return weather_constitution_advice, user_input.replace("天氣", "").strip()
+
+    # === 新增：舌象描述直接呼叫分析工具 ===
+    if TONGUE_PREFIX_PATTERN.match(user_input):
+        return enhanced_tongue_analysis, user_input
+    return None, user_input
+
+async def respond(user_input: str, chat_history: deque) -> Tuple[str, bool]:
+    """
+    依輸入內容分派至工具捷徑或 Agent。
+    返回 (訊息, 是否為回覆)；提示與錯誤訊息不計入對話歷史。
+    """
+    tool_func, tool_input = route(user_input)
+    if tool_func is weather_constitution_advice and not tool_input:
+        return "請輸入城市名稱，例如：天氣 台北", False
+    if tool_func is not None:
+        return await tool_func.ainvoke(tool_input), True
+
+    try:
+        # **修正**: 手動將 System Prompt 添加到 message 列表中
+        messages_with_system_prompt = [SYSTEM_MESSAGE, *chat_history, HumanMessage(content=user_input)]
+
+        response = await ainvoke_agent(messages_with_system_prompt)
+        return response['messages'][-1].content, True
+
+    except Exception as e:
+        logging.error(f"Agent 執行錯誤: {str(e)}", exc_info=True)
+        return f"❌ 系統發生錯誤: {str(e)}", False
+
+def read_line(prompt: str) -> Optional[str]:
+    """讀取一行輸入；輸入結束（EOF）時返回 None"""
+    try:
+        return input(prompt).strip()
+    except EOFError:
+        return None
+
+def read_batch() -> List[str]:
+    """批次模式：持續讀取輸入直到空白行或退出指令，返回收集到的查詢"""
+    batch = []
+    while True:
+        prompt = "🧑 您: " if not batch else "   ... "
+        line = read_line(prompt)
+        if line is None:
+            # 輸入結束時仍處理已收集的查詢，並視為退出
+            batch.append("quit")
+            return batch
+        if not line:
+            return batch
+        batch.append(line)
+        if line.lower() in ['q', 'quit']:
+            return batch
+
+async def main(batch_mode: bool = False):
     global current_user_id
     print("🚀 正在初始化中醫舌象智能分析系統...")
-    user_id_input = input("請輸入您的用戶 ID（或按 Enter 使用 'default_user'）：").strip()
+    user_id_input = read_line("請輸入您的用戶 ID（或按 Enter 使用 'default_user'）：")
     current_user_id = user_id_input or "default_user"
     
     if user_manager.create_user(current_user_id):
@@ -505,93 +776,59 @@ async def main():
     print("4. 個性建議: 輸入 '個性化建議'")
     print("5. 天氣調理: 輸入 '天氣 台北'")
     print("6. 輸入 'q' 或 'quit' 退出系統")
+    if batch_mode:
+        print("📦 批次模式: 每行一則查詢，輸入空白行後一併送出")
     print("━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n")
 
-    chat_history = []
-
-    while True:
-        user_input = input("🧑 您: ").strip()
-
-        if user_input.lower() in ['q', 'quit']:
-            print("👋 感謝使用中醫舌象分析系統，祝您身體健康！")
-            break
-
-        if not user_input:
-            continue
-
-        # === 新增：明確指令直接呼叫工具，提升穩定性 ===
-        if user_input in ["健康趨勢"]:
-            final_answer = get_user_health_trends("")
-            print(f"🤖 AI中醫師: {final_answer}\n")
-            chat_history.append(HumanMessage(content=user_input))
-            chat_history.append(AIMessage(content=final_answer))
-            if len(chat_history) > 10:
-                chat_history = chat_history[-10:]
-            continue
-        if user_input in ["歷史記錄"]:
-            final_answer = get_user_history_formatted("")
-            print(f"🤖 AI中醫師: {final_answer}\n")
-            chat_history.append(HumanMessage(content=user_input))
-            chat_history.append(AIMessage(content=final_answer))
-            if len(chat_history) > 10:
-                chat_history = chat_history[-10:]
-            continue
-        if user_input in ["個性化建議"]:
-            final_answer = get_personalized_advice("")
-            print(f"🤖 AI中醫師: {final_answer}\n")
-            chat_history.append(HumanMessage(content=user_input))
-            chat_history.append(AIMessage(content=final_answer))
-            if len(chat_history) > 10:
-                chat_history = chat_history[-10:]
-            continue
-        if user_input.startswith("天氣"):
-            city = user_input.replace("天氣", "").strip()
-            if not city:
-                print("請輸入城市名稱，例如：天氣 台北\n")
-                continue
-            final_answer = weather_constitution_advice(city)
-            print(f"🤖 AI中醫師: {final_answer}\n")
-            chat_history.append(HumanMessage(content=user_input))
-            chat_history.append(AIMessage(content=final_answer))
-            if len(chat_history) > 10:
-                chat_history = chat_history[-10:]
-            continue
-
-        # === 新增：舌象描述直接呼叫分析工具 ===
-        tongue_types = list(TONGUE_DATABASE.keys())
-        if any(user_input.startswith(t) for t in tongue_types):
-            final_answer = enhanced_tongue_analysis(user_input)
-            print(f"🤖 AI中醫師: {final_answer}\n")
-            chat_history.append(HumanMessage(content=user_input))
-            chat_history.append(AIMessage(content=final_answer))
-            if len(chat_history) > 10:
-                chat_history = chat_history[-10:]
-            continue
-
-        try:
-            # **修正**: 手動將 System Prompt 添加到 message 列表中
-            messages_with_system_prompt = [
-                SystemMessage(content=TCM_SYSTEM_PROMPT)
-            ] + chat_history + [HumanMessage(content=user_input)]
-            
-            response = agent_executor.invoke({
-                "messages": messages_with_system_prompt
-            })
-            
-            final_answer = response['messages'][-1].content
-            print(f"🤖 AI中醫師: {final_answer}\n")
-
-            chat_history.append(HumanMessage(content=user_input))
-            chat_history.append(AIMessage(content=final_answer))
-            
-            if len(chat_history) > 10:
-                chat_history = chat_history[-10:]
-
-        except Exception as e:
-            error_message = f"❌ 系統發生錯誤: {str(e)}"
-            print(error_message)
-            logging.error(f"Agent 執行錯誤: {str(e)}", exc_info=True)
+    chat_history = deque(maxlen=10)
+    running = True
+
+    try:
+        while running:
+            if batch_mode:
+                batch = read_batch()
+            else:
+                line = read_line("🧑 您: ")
+                batch = ["quit" if line is None else line]
+
+            queries = []
+            for user_input in batch:
+                if user_input.lower() in ['q', 'quit']:
+                    running = False
+                    break
+                if user_input:
+                    queries.append(user_input)
+
+            # 工具捷徑會讀寫用戶記錄，依輸入順序逐一執行；僅 Agent 呼叫並行送出
+            answers: List[Optional[Tuple[str, bool]]] = [None] * len(queries)
+            agent_tasks = []
+            for i, user_input in enumerate(queries):
+                if route(user_input)[0] is not None:
+                    answers[i] = await respond(user_input, chat_history)
+                else:
+                    agent_tasks.append((i, asyncio.create_task(respond(user_input, chat_history))))
+            for i, task in agent_tasks:
+                answers[i] = await task
+            for user_input, (final_answer, is_reply) in zip(queries, answers):
+                if len(queries) > 1:
+                    print(f"🧑 {user_input}")
+                if not is_reply:
+                    print(f"{final_answer}\n")
+                    continue
+                print(f"🤖 AI中醫師: {final_answer}\n")
+                record_turn(chat_history, user_input, final_answer)
+
+        print("👋 感謝使用中醫舌象分析系統，祝您身體健康！")
+    finally:
+        await weather_client.aclose()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="中醫舌象智能分析系統")
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="批次模式：收集多行查詢直到空白行，再並行送出",
+    )
+    args = parser.parse_args()
+    asyncio.run(main(batch_mode=args.batch))